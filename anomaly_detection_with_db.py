@@ -10,15 +10,26 @@ import numpy as np
 import os
 import sys
 import glob
+import functools
+import atexit
 import re
 import logging
+import warnings
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from database_integration import DatabaseIntegration
+from excel_engine import EXCEL_READ_ENGINE
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Lookback columns, oldest first
+HISTORY_COLUMNS = [f"{i}_Months_ago" for i in range(5, 0, -1)]
+
+# mm-cc-yyyy part of a sample file name; the cycle number can be one or two digits
+CYCLE_FILE_RE = re.compile(r"Sample_Billing_Cycle_(\d{2}-\d+-\d{4})")
+
 # ---------------------------
 # 1. Data Loading
 # ---------------------------
@@ -38,13 +49,17 @@ def load_sample_billing_data(filepath=None):
         logger.info(f"Loading file: {filepath}")
         
     # Extract mm-cc-yyyy from filename
-    match = re.search(r"Sample_Billing_Cycle_(\d{2}-\d-\d{4})", os.path.basename(filepath))
+    match = CYCLE_FILE_RE.search(os.path.basename(filepath))
     mm_cc_yyyy = match.group(1) if match else "cycle"
     
     # Read all sheets and concatenate
-    all_sheets = pd.read_excel(filepath, sheet_name=None)
+    all_sheets = pd.read_excel(filepath, sheet_name=None, engine=EXCEL_READ_ENGINE)
     df = pd.concat(all_sheets.values(), ignore_index=True)
     
+    # Codes and bill types repeat heavily; store them as small integer codes
+    for col in ("Bill_TYPE", "Billing_CODE"):
+        df[col] = df[col].astype("category")
+    
     return df, mm_cc_yyyy, filepath
 
 # ---------------------------
@@ -54,98 +69,198 @@ def clean_data(df):
     """
     Clean and preprocess the billing data.
     """
-    # Ensure numeric columns are floats
-    for col in [f"{i}_Months_ago" for i in range(5, 0, -1)] + ["Active Month"]:
-        df[col] = pd.to_numeric(df[col], errors='coerce')
+    # Ensure numeric columns are floats. Amounts run into the millions with
+    # cents, which float32 (~7 significant digits) cannot hold, so keep float64.
+    num_cols = HISTORY_COLUMNS + ["Active Month"]
+    numeric = df[num_cols]
+    if not all(pd.api.types.is_numeric_dtype(dtype) for dtype in numeric.dtypes):
+        # Only coerce when the sheet carried text or mixed cells
+        numeric = numeric.apply(pd.to_numeric, errors='coerce')
+    df[num_cols] = numeric.astype(np.float64)
     return df
 
 # ---------------------------
 # 3. Feature Engineering
 # ---------------------------
+def _rolling_average(hist):
+    """Row means of the (N, 5) history block, ignoring missing months."""
+    with warnings.catch_warnings():
+        # Rows with no history average to NaN, same as DataFrame.mean
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        return np.nanmean(hist, axis=1)
+
+def _deltas(active, rolling_avg, last_month):
+    """Active vs avg and MoM changes, absolute and relative, keyed by column name."""
+    # Multiply by reciprocals of the baselines. A zero baseline gives an inf
+    # reciprocal, so x/0 still yields +/-inf and 0/0 still yields NaN.
+    with np.errstate(divide="ignore", invalid="ignore"):
+        inv_rolling_avg = 1.0 / rolling_avg
+        inv_last_month = 1.0 / last_month
+        active_vs_avg = active - rolling_avg
+        mom_change = active - last_month
+        return {
+            "Active_vs_Avg": active_vs_avg,
+            "Pct_Change_Active_vs_Avg": active_vs_avg * inv_rolling_avg,
+            "MoM_Change": mom_change,
+            "Pct_Change_MoM": mom_change * inv_last_month,
+        }
+
+def _special_cases(hist, active):
+    """Drop-to-0 and new-code masks from the history block and the active month."""
+    no_history = np.isnan(hist).all(axis=1)
+    active_nan = np.isnan(active)
+    return (active_nan | (active == 0)) & ~no_history, no_history & ~active_nan
+
 def calculate_rolling_average(df):
     """
     Calculate rolling average of previous 5 months for each row.
     """
-    df["Rolling_Avg"] = df[[f"{i}_Months_ago" for i in range(5, 0, -1)]].mean(axis=1)
+    df["Rolling_Avg"] = _rolling_average(df[HISTORY_COLUMNS].to_numpy(dtype=np.float64))
     return df
 
 def calculate_deltas(df):
     """
     Calculate active vs avg, percent change, MoM change, etc.
     """
-    df["Active_vs_Avg"] = df["Active Month"] - df["Rolling_Avg"]
-    df["Pct_Change_Active_vs_Avg"] = df["Active_vs_Avg"] / df["Rolling_Avg"]
-    df["MoM_Change"] = df["Active Month"] - df["1_Months_ago"]
-    df["Pct_Change_MoM"] = df["MoM_Change"] / df["1_Months_ago"]
+    deltas = _deltas(df["Active Month"].to_numpy(dtype=np.float64),
+                     df["Rolling_Avg"].to_numpy(dtype=np.float64),
+                     df["1_Months_ago"].to_numpy(dtype=np.float64))
+    for column, values in deltas.items():
+        df[column] = values
     return df
 
 def flag_special_cases(df):
     """
     Flag drop to 0 and new code cases.
     """
-    df["Drop_to_0"] = df.apply(
-        lambda row: (row["Active Month"] == 0 or pd.isna(row["Active Month"])) and
-                    any([not pd.isna(row[f"{i}_Months_ago"]) for i in range(5, 0, -1)]),
-        axis=1
-    )
-    df["New_Code"] = df.apply(
-        lambda row: all([pd.isna(row[f"{i}_Months_ago"]) for i in range(5, 0, -1)]) and
-                    not pd.isna(row["Active Month"]),
-        axis=1
-    )
+    # Vectorized over the (N, 5) history block instead of a per-row apply
+    df["Drop_to_0"], df["New_Code"] = _special_cases(df[HISTORY_COLUMNS].to_numpy(dtype=np.float64),
+                                                     df["Active Month"].to_numpy(dtype=np.float64))
     return df
 
 # ---------------------------
 # 4. Anomaly Detection Logic
 # ---------------------------
+def _mean_std(values):
+    """
+    Mean and sample standard deviation of the non-NaN values, matching
+    Series.mean() / Series.std(). NaNs are dropped once and the centered
+    values are reused for the variance.
+    """
+    values = values[~np.isnan(values)]
+    if values.size == 0:
+        return np.nan, np.nan
+    mean = values.mean()
+    if values.size == 1:
+        return mean, np.nan
+    centered = values - mean
+    return mean, np.sqrt(np.dot(centered, centered) / (values.size - 1))
+
+def _anomaly_flags(deviation, pct_change, drop_to_0, new_code, z_thresh, pct_thresh):
+    """Z-score of Active_vs_Avg and the combined anomaly mask."""
+    mean, std = _mean_std(deviation)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z_score = (deviation - mean) / std
+    return z_score, (
+        (np.abs(z_score) > z_thresh) |
+        (np.abs(pct_change) > pct_thresh) |
+        drop_to_0 |
+        new_code
+    )
+
 def flag_anomalies(df, z_thresh=2.5, pct_thresh=0.5):
     """
     Flag anomalies based on z-score and percent change.
     """
-    # Z-score for Active_vs_Avg
-    df["Active_vs_Avg_z"] = (df["Active_vs_Avg"] - df["Active_vs_Avg"].mean()) / df["Active_vs_Avg"].std()
-    df["Anomaly"] = (
-        (df["Active_vs_Avg_z"].abs() > z_thresh) |
-        (df["Pct_Change_Active_vs_Avg"].abs() > pct_thresh) |
-        (df["Drop_to_0"]) |
-        (df["New_Code"])
-    )
+    df["Active_vs_Avg_z"], df["Anomaly"] = _anomaly_flags(
+        df["Active_vs_Avg"].to_numpy(dtype=np.float64),
+        df["Pct_Change_Active_vs_Avg"].to_numpy(dtype=np.float64),
+        df["Drop_to_0"].to_numpy(dtype=bool),
+        df["New_Code"].to_numpy(dtype=bool),
+        z_thresh, pct_thresh)
+    return df
+
+def run_pipeline(df, z_thresh=2.5, pct_thresh=0.5):
+    """
+    Clean the data and add every feature and flag column in one pass.
+    Same result as clean_data -> calculate_rolling_average -> calculate_deltas
+    -> flag_special_cases -> flag_anomalies, but the amounts are read into one
+    array once and each derived column is computed from arrays, never re-read
+    from the frame.
+    """
+    df = clean_data(df)
+    amounts = df[HISTORY_COLUMNS + ["Active Month"]].to_numpy(dtype=np.float64)
+    hist, active = amounts[:, :-1], amounts[:, -1]
+    
+    rolling_avg = _rolling_average(hist)
+    # HISTORY_COLUMNS is oldest first, so the last history column is 1_Months_ago
+    deltas = _deltas(active, rolling_avg, hist[:, -1])
+    drop_to_0, new_code = _special_cases(hist, active)
+    z_score, anomaly = _anomaly_flags(deltas["Active_vs_Avg"], deltas["Pct_Change_Active_vs_Avg"],
+                                      drop_to_0, new_code, z_thresh, pct_thresh)
+    
+    # Same column order as the staged functions
+    features = {"Rolling_Avg": rolling_avg, **deltas, "Drop_to_0": drop_to_0, "New_Code": new_code,
+                "Active_vs_Avg_z": z_score, "Anomaly": anomaly}
+    for column, values in features.items():
+        df[column] = values
     return df
 
 # ---------------------------
 # 5. Join Code Descriptions (for anomalies only)
 # ---------------------------
-def join_code_descriptions(anomalies_df):
+@functools.lru_cache(maxsize=1)
+def load_code_descriptions():
+    """
+    Load the SEC and ACR code description files as {Billing_CODE: description} dicts.
+    Cached for the life of the process, so batch runs read each file once.
+    """
     desc_dir = os.path.join("data", "descriptions")
-    sec_desc = pd.read_excel(os.path.join(desc_dir, "Single_Event_Charges_Descriptions.xlsx"))
-    acr_desc = pd.read_excel(os.path.join(desc_dir, "Account_Corrections_Descriptions.xlsx"))
-    sec_desc = sec_desc.rename(columns={"Billing_CODE": "Billing_CODE", "Billing Code Description": "SEC_Description"})
-    acr_desc = acr_desc.rename(columns={"Billing_CODE": "Billing_CODE", "Billing Code Description": "ACR_Description"})
+    sec_desc = pd.read_excel(os.path.join(desc_dir, "Single_Event_Charges_Descriptions.xlsx"),
+                             engine=EXCEL_READ_ENGINE)
+    acr_desc = pd.read_excel(os.path.join(desc_dir, "Account_Corrections_Descriptions.xlsx"),
+                             engine=EXCEL_READ_ENGINE)
+    sec_map = dict(zip(sec_desc["Billing_CODE"], sec_desc["Billing Code Description"]))
+    acr_map = dict(zip(acr_desc["Billing_CODE"], acr_desc["Billing Code Description"]))
+    return sec_map, acr_map
 
-    # Merge SEC descriptions
-    anomalies_df = anomalies_df.merge(sec_desc, on="Billing_CODE", how="left")
-    # Merge ACR descriptions
-    anomalies_df = anomalies_df.merge(acr_desc, on="Billing_CODE", how="left")
+def join_code_descriptions(anomalies_df):
+    sec_map, acr_map = load_code_descriptions()
+
+    # Look up descriptions per code (description tables have one row per code)
+    codes = anomalies_df["Billing_CODE"]
+    sec_description = codes.map(sec_map).to_numpy(dtype=object)
+    acr_description = codes.map(acr_map).to_numpy(dtype=object)
 
     # Fill Billing Code Description based on Bill_TYPE
-    anomalies_df["Billing Code Description"] = anomalies_df.apply(
-        lambda row: row["SEC_Description"] if row["Bill_TYPE"] == "SEC" else (
-            row["ACR_Description"] if row["Bill_TYPE"] == "ACR" else row["Billing Code Description"]
-        ), axis=1
-    )
-    # Drop helper columns
-    anomalies_df = anomalies_df.drop(columns=["SEC_Description", "ACR_Description"])
-    return anomalies_df
+    bill_type = anomalies_df["Bill_TYPE"].to_numpy()
+    return anomalies_df.assign(**{"Billing Code Description": np.where(
+        bill_type == "SEC", sec_description,
+        np.where(bill_type == "ACR", acr_description,
+                 anomalies_df["Billing Code Description"].to_numpy(dtype=object))
+    )})
 
 # ---------------------------
 # 6. Database Integration
 # ---------------------------
+_db_integration = None
+
+def get_db():
+    """
+    Return the process-wide DatabaseIntegration, opening it on first use.
+    The connection is shared by every stage below and closed at exit.
+    """
+    global _db_integration
+    if _db_integration is None:
+        _db_integration = DatabaseIntegration()
+        atexit.register(_db_integration.close)
+    return _db_integration
+
 def process_with_database(df, mm_cc_yyyy, file_path=None):
     """
     Process the data and store everything in the database.
     """
-    # Initialize database integration
-    db_integration = DatabaseIntegration()
+    db_integration = get_db()
     
     try:
         # Extract cycle information from mm_cc_yyyy
@@ -173,10 +288,6 @@ def process_with_database(df, mm_cc_yyyy, file_path=None):
         records_stored = db_integration.store_billing_data(cycle_id, df)
         logger.info(f"Stored {records_stored} billing records in database")
         
-        # Store detailed anomaly information
-        anomalies_stored = db_integration.store_anomaly_details(cycle_id, df)
-        logger.info(f"Stored {anomalies_stored} anomaly details in database")
-        
         # Update processing cycle statistics
         db_integration.update_processing_cycle_stats(cycle_id)
         
@@ -205,24 +316,23 @@ def process_with_database(df, mm_cc_yyyy, file_path=None):
             db_integration.log_processing_event(cycle_id, f"Processing failed: {e}", "ERROR")
         raise
     finally:
-        del db_integration
+        # Pool workers exit without running atexit, so write this cycle's log now
+        db_integration.flush_log()
 
 # ---------------------------
 # 7. Output Results (Enhanced)
 # ---------------------------
-def output_results(df, mm_cc_yyyy, cycle_id=None):
+def anomaly_report_path(mm_cc_yyyy):
+    """Path of the analyst anomaly report for a cycle."""
+    return os.path.join("data", "Anomalies", f"Anomalies_{mm_cc_yyyy}.xlsx")
+
+def write_anomaly_report(anomalies, mm_cc_yyyy):
     """
-    Output results to Excel files (anomaly reports for analysts).
+    Write the anomaly rows to a formatted Excel report for analysts.
     """
-    import openpyxl
-    from openpyxl.utils.dataframe import dataframe_to_rows
-    from openpyxl.styles import numbers
-
-    output_dir = os.path.join("data", "Anomalies")
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+    anomaly_file_xlsx = anomaly_report_path(mm_cc_yyyy)
+    os.makedirs(os.path.dirname(anomaly_file_xlsx), exist_ok=True)
         
-    anomalies = df[df["Anomaly"]].copy()
     anomalies = join_code_descriptions(anomalies)
 
     # Move 'Billing Code Description' to the end
@@ -230,97 +340,131 @@ def output_results(df, mm_cc_yyyy, cycle_id=None):
         cols = [c for c in anomalies.columns if c != 'Billing Code Description'] + ['Billing Code Description']
         anomalies = anomalies[cols]
 
-    anomaly_file_xlsx = os.path.join(output_dir, f"Anomalies_{mm_cc_yyyy}.xlsx")
-
     # Write to Excel with formatting
-    with pd.ExcelWriter(anomaly_file_xlsx, engine="openpyxl") as writer:
+    with pd.ExcelWriter(anomaly_file_xlsx, engine="xlsxwriter") as writer:
         anomalies.to_excel(writer, index=False, sheet_name="Anomalies")
         ws = writer.sheets["Anomalies"]
+        percent_fmt = writer.book.add_format({"num_format": "0.00%"})
+        currency_fmt = writer.book.add_format({"num_format": "[$$-409]#,##0.00"})
         # Find columns to format
-        percent_cols = [i+1 for i, c in enumerate(anomalies.columns) if 'Pct_' in c or 'Percent' in c]
-        currency_cols = [i+1 for i, c in enumerate(anomalies.columns) if (
+        percent_cols = [i for i, c in enumerate(anomalies.columns) if 'Pct_' in c or 'Percent' in c]
+        currency_cols = [i for i, c in enumerate(anomalies.columns) if (
             c == 'Active Month' or c == 'Rolling_Avg' or c == 'Active_vs_Avg' or c == 'MoM_Change' or c.endswith('_Months_ago'))]
-        # Apply formatting (skip header row)
-        for row in ws.iter_rows(min_row=2, max_row=ws.max_row):
-            for idx in percent_cols:
-                cell = row[idx-1]
-                cell.number_format = '0.00%'
-            for idx in currency_cols:
-                cell = row[idx-1]
-                cell.number_format = '[$$-409]#,##0.00'
+        # Apply formatting per column (data cells inherit it; the styled header row keeps its own)
+        for idx in percent_cols:
+            ws.set_column(idx, idx, None, percent_fmt)
+        for idx in currency_cols:
+            ws.set_column(idx, idx, None, currency_fmt)
                 
     logger.info(f"Anomaly report saved to: {anomaly_file_xlsx}")
+
+def output_results(df, mm_cc_yyyy, cycle_id=None, db_integration=None):
+    """
+    Output results to Excel files (anomaly reports for analysts).
+    Pass db_integration to export through an open connection instead of get_db().
+    """
+    # Positional take of the flagged rows; join_code_descriptions returns a new frame
+    anomaly_idx = np.flatnonzero(df["Anomaly"].to_numpy(dtype=bool))
+    if anomaly_idx.size:
+        write_anomaly_report(df.take(anomaly_idx), mm_cc_yyyy)
+    else:
+        logger.info(f"No anomalies in cycle {mm_cc_yyyy}; skipping anomaly report")
+        # A report left by an earlier run of this cycle would now list stale anomalies
+        stale_report = anomaly_report_path(mm_cc_yyyy)
+        if os.path.exists(stale_report):
+            os.remove(stale_report)
+            logger.info(f"Removed outdated anomaly report: {stale_report}")
     
     # If we have a cycle_id, also export the full dataset from database
     if cycle_id:
-        db_integration = DatabaseIntegration()
         try:
             db_output_path = os.path.join("data", "Database_Exports", f"Full_Cycle_Data_{mm_cc_yyyy}.xlsx")
             os.makedirs(os.path.dirname(db_output_path), exist_ok=True)
             
-            if db_integration.export_cycle_to_excel(cycle_id, db_output_path):
+            if (db_integration or get_db()).export_cycle_to_excel(cycle_id, db_output_path):
                 logger.info(f"Full cycle data exported to: {db_output_path}")
         except Exception as e:
             logger.error(f"Database export failed: {e}")
-        finally:
-            del db_integration
 
 # ---------------------------
 # 8. Database Query Functions
 # ---------------------------
 def get_processing_history():
     """Get processing history from database."""
-    db_integration = DatabaseIntegration()
-    try:
-        cycles = db_integration.get_all_cycles()
-        logger.info("Processing History:")
-        for cycle in cycles:
-            cycle_id, cycle_date, cycle_num, year, month, total_rec, anomaly_count, status, timestamp = cycle
-            logger.info(f"  Cycle {cycle_id}: {cycle_date} - {total_rec} records, {anomaly_count} anomalies ({status})")
+    cycles = get_db().get_all_cycles()
+    if not cycles:
+        logger.info("Processing History: no cycles processed yet")
         return cycles
-    finally:
-        del db_integration
+    logger.info("Processing History:")
+    for cycle in cycles:
+        cycle_id, cycle_date, cycle_num, year, month, total_rec, anomaly_count, status, timestamp, file_path = cycle
+        logger.info(f"  Cycle {cycle_id}: {cycle_date} - {total_rec} records, {anomaly_count} anomalies ({status})")
+    return cycles
 
 def get_code_history(billing_code):
     """Get historical data for a specific billing code."""
-    db_integration = DatabaseIntegration()
-    try:
-        history = db_integration.get_billing_code_history(billing_code)
-        logger.info(f"History for billing code {billing_code}:")
-        for record in history:
-            cycle_id, code, bill_type, amount, rolling_avg, deviation, is_anomaly, cycle_date, timestamp = record
-            logger.info(f"  {cycle_date}: ${amount:,.2f} (deviation: ${deviation:,.2f}, anomaly: {is_anomaly})")
+    history = get_db().get_billing_code_history(billing_code)
+    if not history:
+        logger.info(f"No history for billing code {billing_code}")
         return history
-    finally:
-        del db_integration
+    logger.info(f"History for billing code {billing_code}:")
+    for record in history:
+        cycle_id, code, bill_type, amount, rolling_avg, deviation, is_anomaly, cycle_date, timestamp = record
+        logger.info(f"  {cycle_date}: ${amount:,.2f} (deviation: ${deviation:,.2f}, anomaly: {is_anomaly})")
+    return history
 
 # ---------------------------
 # 9. Main Execution
 # ---------------------------
+def run_cycle(filepath=None):
+    """
+    Run detection for one billing cycle file, store it, and write its reports.
+    Returns: cycle_id, summary
+    """
+    # Load and process data
+    df, mm_cc_yyyy, file_path = load_sample_billing_data(filepath)
+    df = run_pipeline(df)
+    
+    # Process with database integration
+    cycle_id, summary = process_with_database(df, mm_cc_yyyy, file_path)
+    
+    # Output results
+    output_results(df, mm_cc_yyyy, cycle_id)
+    return cycle_id, summary
+
 if __name__ == "__main__":
-    # Accept file path as argument
-    filepath = sys.argv[1] if len(sys.argv) > 1 else None
+    # Accept one or more file paths as arguments
+    filepaths = sys.argv[1:] or [None]
     
     try:
-        # Load and process data
-        df, mm_cc_yyyy, file_path = load_sample_billing_data(filepath)
-        df = clean_data(df)
-        df = calculate_rolling_average(df)
-        df = calculate_deltas(df)
-        df = flag_special_cases(df)
-        df = flag_anomalies(df)
+        failed = []
+        if len(filepaths) == 1:
+            run_cycle(filepaths[0])
+        else:
+            # Cycles are independent; each worker process opens its own connection and
+            # store_billing_data takes the write lock for its whole cycle
+            workers = min(len(filepaths), os.cpu_count() or 1)
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = {executor.submit(run_cycle, filepath): filepath for filepath in filepaths}
+                # One bad file does not cancel the others; report each failure on its own
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logger.error(f"Processing failed for {futures[future]}: {e}")
+                        failed.append(futures[future])
         
-        # Process with database integration
-        cycle_id, summary = process_with_database(df, mm_cc_yyyy, file_path)
-        
-        # Output results
-        output_results(df, mm_cc_yyyy, cycle_id)
-        
-        logger.info("Anomaly detection with database integration complete.")
+        if failed:
+            logger.error(f"{len(failed)} of {len(filepaths)} cycle files failed")
+        else:
+            logger.info("Anomaly detection with database integration complete.")
         
         # Show processing history
         get_processing_history()
         
+        if failed:
+            sys.exit(1)
+        
     except Exception as e:
         logger.error(f"Processing failed: {e}")
         sys.exit(1) 
\ No newline at end of file
@@ -9,18 +9,49 @@ import sqlite3
 import pandas as pd
 import logging
 from datetime import datetime
-from database_setup import BillingDatabase
+from database_setup import BillingDatabase, BILLING_DATA_COLUMNS
 
 logger = logging.getLogger(__name__)
 
+# billing_data column -> (DataFrame column, value used when that column is missing)
+_BILLING_DATA_SOURCES = {
+    'billing_code': ('Billing_CODE', None),
+    'bill_type': ('Bill_TYPE', None),
+    'year': ('Year', None),
+    'month': ('Month', None),
+    'bill_cycle_number': ('Bill Cycle Number', None),
+    'amount_5_months_ago': ('5_Months_ago', None),
+    'amount_4_months_ago': ('4_Months_ago', None),
+    'amount_3_months_ago': ('3_Months_ago', None),
+    'amount_2_months_ago': ('2_Months_ago', None),
+    'amount_1_month_ago': ('1_Months_ago', None),
+    'active_month_amount': ('Active Month', None),
+    'rolling_average': ('Rolling_Avg', None),
+    'active_vs_avg': ('Active_vs_Avg', None),
+    'pct_change_active_vs_avg': ('Pct_Change_Active_vs_Avg', None),
+    'mom_change': ('MoM_Change', None),
+    'pct_change_mom': ('Pct_Change_MoM', None),
+    'drop_to_zero': ('Drop_to_0', False),
+    'new_code': ('New_Code', False),
+    'active_vs_avg_z_score': ('Active_vs_Avg_z', None),
+    'is_anomaly': ('Anomaly', False),
+    'description': ('Billing Code Description', ''),
+}
+
 class DatabaseIntegration:
-    def __init__(self, db_path="billing_anomaly_detection.db"):
+    def __init__(self, db_path="billing_anomaly_detection.db", pragmas=None):
         """Initialize database integration."""
-        self.db = BillingDatabase(db_path)
+        self.db = BillingDatabase(db_path, pragmas)
         self.db.connect()
+        # (billing_code, bill_type) -> (code_id, description) for codes already in the database
+        self._code_cache = {}
         
     def __del__(self):
         """Cleanup database connection."""
+        self.close()
+        
+    def close(self):
+        """Close the database connection (safe to call more than once)."""
         if hasattr(self, 'db'):
             self.db.disconnect()
             
@@ -33,103 +64,138 @@ class DatabaseIntegration:
         """, (cycle_date, cycle_number, year, month, file_path, datetime.now()))
         
         cycle_id = self.db.cursor.lastrowid
-        self.db.conn.commit()
+        self.db.commit()
         logger.info(f"Created processing cycle {cycle_id} for {cycle_date}")
         return cycle_id
         
     def get_or_create_billing_code(self, billing_code, bill_type, description=None):
-        """Get existing billing code or create new one."""
-        # Check if code exists
-        self.db.cursor.execute("""
-            SELECT code_id, description FROM billing_codes 
-            WHERE billing_code = ? AND bill_type = ?
-        """, (billing_code, bill_type))
-        
-        result = self.db.cursor.fetchone()
+        """Get existing billing code or create new one.
         
-        if result:
-            code_id, existing_description = result
-            # Update description if provided and different
-            if description and description != existing_description:
+        Runs in its own write transaction, or inside the caller's if one is open.
+        """
+        key = (billing_code, bill_type)
+        with self.db.write_transaction():
+            result = self._code_cache.get(key)
+            
+            if result is None:
+                # Check if code exists
                 self.db.cursor.execute("""
-                    UPDATE billing_codes SET description = ? WHERE code_id = ?
-                """, (description, code_id))
-                self.db.conn.commit()
-            return code_id
-        else:
-            # Create new billing code
-            self.db.cursor.execute("""
-                INSERT INTO billing_codes (billing_code, bill_type, description, first_seen_date)
-                VALUES (?, ?, ?, ?)
-            """, (billing_code, bill_type, description, datetime.now().strftime('%Y-%m-%d')))
+                    SELECT code_id, description FROM billing_codes 
+                    WHERE billing_code = ? AND bill_type = ?
+                """, key)
+                result = self.db.cursor.fetchone()
             
-            code_id = self.db.cursor.lastrowid
-            self.db.conn.commit()
-            logger.info(f"Created new billing code: {billing_code} ({bill_type})")
-            return code_id
+            if result:
+                code_id, existing_description = result
+                self._code_cache[key] = result
+                # Update description if provided and different
+                if description and description != existing_description:
+                    self.db.cursor.execute("""
+                        UPDATE billing_codes SET description = ? WHERE code_id = ?
+                    """, (description, code_id))
+                    self._code_cache[key] = (code_id, description)
+                return code_id
+            else:
+                # Create new billing code
+                self.db.cursor.execute("""
+                    INSERT INTO billing_codes (billing_code, bill_type, description, first_seen_date)
+                    VALUES (?, ?, ?, ?)
+                """, (billing_code, bill_type, description, datetime.now().strftime('%Y-%m-%d')))
+                
+                code_id = self.db.cursor.lastrowid
+                self._code_cache[key] = (code_id, description)
+                logger.info(f"Created new billing code: {billing_code} ({bill_type})")
+                return code_id
             
-    def store_billing_data(self, cycle_id, df):
-        """Store all billing data for a cycle."""
-        records_inserted = 0
-        
-        for _, row in df.iterrows():
-            # Get or create billing code
-            code_id = self.get_or_create_billing_code(
-                row['Billing_CODE'], 
-                row['Bill_TYPE'],
-                row.get('Billing Code Description', '')
-            )
+    def _fetch_billing_codes(self, billing_codes):
+        """Return {(billing_code, bill_type): (code_id, description)} for existing codes."""
+        found = {}
+        billing_codes = list(billing_codes)
+        # Chunk the IN list to stay under SQLite's bound-parameter limit
+        for start in range(0, len(billing_codes), 500):
+            chunk = billing_codes[start:start + 500]
+            self.db.cursor.execute(f"""
+                SELECT billing_code, bill_type, code_id, description FROM billing_codes
+                WHERE billing_code IN ({', '.join('?' * len(chunk))})
+            """, chunk)
+            for billing_code, bill_type, code_id, description in self.db.cursor.fetchall():
+                found[(billing_code, bill_type)] = (code_id, description)
+        self._code_cache.update(found)
+        return found
+        
+    def resolve_billing_codes(self, df):
+        """Get or create the code_id of every (billing code, bill type) pair in a cycle."""
+        # Unique pairs in first-seen order; the last non-empty description wins
+        descriptions = (df['Billing Code Description'].tolist()
+                        if 'Billing Code Description' in df.columns else [''] * len(df))
+        pairs = {}
+        described = set()
+        for key, description in zip(zip(df['Billing_CODE'].tolist(), df['Bill_TYPE'].tolist()), descriptions):
+            if isinstance(description, str) and description:
+                pairs[key] = description
+                described.add(key)
+            else:
+                pairs.setdefault(key, description)
+                
+        # Only codes not seen earlier in this session need a lookup
+        existing = {key: self._code_cache[key] for key in pairs if key in self._code_cache}
+        existing.update(self._fetch_billing_codes(
+            {billing_code for billing_code, bill_type in pairs if (billing_code, bill_type) not in existing}))
+        
+        # Update descriptions that changed
+        updates = [(pairs[key], existing[key][0]) for key in described
+                   if key in existing and pairs[key] != existing[key][1]]
+        if updates:
+            self.db.cursor.executemany("""
+                UPDATE billing_codes SET description = ? WHERE code_id = ?
+            """, updates)
+            for key in described:
+                if key in existing:
+                    self._code_cache[key] = (existing[key][0], pairs[key])
             
-            # Prepare data for insertion
-            data = {
-                'cycle_id': cycle_id,
-                'code_id': code_id,
-                'billing_code': row['Billing_CODE'],
-                'bill_type': row['Bill_TYPE'],
-                'year': row['Year'],
-                'month': row['Month'],
-                'bill_cycle_number': row['Bill Cycle Number'],
-                'amount_5_months_ago': row.get('5_Months_ago'),
-                'amount_4_months_ago': row.get('4_Months_ago'),
-                'amount_3_months_ago': row.get('3_Months_ago'),
-                'amount_2_months_ago': row.get('2_Months_ago'),
-                'amount_1_month_ago': row.get('1_Months_ago'),
-                'active_month_amount': row['Active Month'],
-                'rolling_average': row.get('Rolling_Avg'),
-                'active_vs_avg': row.get('Active_vs_Avg'),
-                'pct_change_active_vs_avg': row.get('Pct_Change_Active_vs_Avg'),
-                'mom_change': row.get('MoM_Change'),
-                'pct_change_mom': row.get('Pct_Change_MoM'),
-                'drop_to_zero': row.get('Drop_to_0', False),
-                'new_code': row.get('New_Code', False),
-                'active_vs_avg_z_score': row.get('Active_vs_Avg_z'),
-                'is_anomaly': row.get('Anomaly', False),
-                'description': row.get('Billing Code Description', '')
-            }
+        # Create the codes seen for the first time
+        first_seen = datetime.now().strftime('%Y-%m-%d')
+        new_codes = [(billing_code, bill_type, description, first_seen)
+                     for (billing_code, bill_type), description in pairs.items()
+                     if (billing_code, bill_type) not in existing]
+        if new_codes:
+            self.db.cursor.executemany("""
+                INSERT INTO billing_codes (billing_code, bill_type, description, first_seen_date)
+                VALUES (?, ?, ?, ?)
+            """, new_codes)
+            existing.update(self._fetch_billing_codes(billing_code for billing_code, _, _, _ in new_codes))
+            logger.info(f"Created {len(new_codes)} new billing codes")
             
-            # Insert billing data
-            self.db.cursor.execute("""
-                INSERT INTO billing_data (
-                    cycle_id, code_id, billing_code, bill_type, year, month, bill_cycle_number,
-                    amount_5_months_ago, amount_4_months_ago, amount_3_months_ago, 
-                    amount_2_months_ago, amount_1_month_ago, active_month_amount,
-                    rolling_average, active_vs_avg, pct_change_active_vs_avg,
-                    mom_change, pct_change_mom, drop_to_zero, new_code,
-                    active_vs_avg_z_score, is_anomaly, description
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                data['cycle_id'], data['code_id'], data['billing_code'], data['bill_type'],
-                data['year'], data['month'], data['bill_cycle_number'],
-                data['amount_5_months_ago'], data['amount_4_months_ago'], data['amount_3_months_ago'],
-                data['amount_2_months_ago'], data['amount_1_month_ago'], data['active_month_amount'],
-                data['rolling_average'], data['active_vs_avg'], data['pct_change_active_vs_avg'],
-                data['mom_change'], data['pct_change_mom'], data['drop_to_zero'], data['new_code'],
-                data['active_vs_avg_z_score'], data['is_anomaly'], data['description']
-            ))
+        return {key: existing[key][0] for key in pairs}
             
-            records_inserted += 1
+    def store_billing_data(self, cycle_id, df):
+        """Store all billing data for a cycle.
+        
+        Codes and rows are written in a single transaction, so a crash
+        mid-cycle loses only this cycle's batch and never leaves it half-stored.
+        """
+        # Align to the billing_data columns in one reindex, filling missing ones with their defaults
+        # (cycle_id and code_id lead BILLING_DATA_COLUMNS and are filled in below)
+        sources = [_BILLING_DATA_SOURCES[column][0] for column in BILLING_DATA_COLUMNS[2:]]
+        missing = {source: default for source, default in _BILLING_DATA_SOURCES.values()
+                   if source not in df.columns}
+        aligned = df.reindex(columns=sources).assign(**missing)
+        # tolist() yields plain Python scalars, which sqlite3 can bind
+        columns = [aligned[source].tolist() for source in sources]
+        
+        try:
+            # Hold the write lock from the code lookup to the last row, so two processes
+            # storing cycles at once cannot both find a code missing and both insert it
+            with self.db.write_transaction():
+                code_ids = self.resolve_billing_codes(df)
+                # billing_code and bill_type come first, so values[:2] is the code key
+                rows = ((cycle_id, code_ids[values[:2]], *values) for values in zip(*columns))
+                records_inserted = self.db.insert_billing_data(rows)
+        except Exception:
+            # Codes cached during a failed cycle may have been rolled back
+            self._code_cache.clear()
+            raise
             
-        self.db.conn.commit()
         logger.info(f"Stored {records_inserted} billing records for cycle {cycle_id}")
         return records_inserted
         
@@ -145,13 +211,17 @@ class DatabaseIntegration:
                 WHERE cycle_id = ?
             """, (total_records, anomaly_count, cycle_id))
             
-            self.db.conn.commit()
+            self.db.commit()
             logger.info(f"Updated cycle {cycle_id} stats: {total_records} records, {anomaly_count} anomalies")
             
     def log_processing_event(self, cycle_id, message, level="INFO"):
         """Log a processing event."""
         self.db.log_processing_event(cycle_id, level, message)
         
+    def flush_log(self):
+        """Write buffered processing events; call at the end of each cycle."""
+        self.db.flush_log()
+        
     def get_cycle_summary(self, cycle_id):
         """Get a summary of processing results for a cycle."""
         # Get cycle info
@@ -189,12 +259,23 @@ class DatabaseIntegration:
         """Get list of all processed cycles."""
         self.db.cursor.execute("""
             SELECT cycle_id, cycle_date, cycle_number, year, month, 
-                   total_records, anomaly_count, status, processing_timestamp
+                   total_records, anomaly_count, status, processing_timestamp, file_path
             FROM processing_cycles 
             ORDER BY processing_timestamp DESC
         """)
         return self.db.cursor.fetchall()
         
+    def get_random_cycles(self, n):
+        """Get n randomly chosen cycles (same columns as get_all_cycles), sampled in SQLite."""
+        self.db.cursor.execute("""
+            SELECT cycle_id, cycle_date, cycle_number, year, month, 
+                   total_records, anomaly_count, status, processing_timestamp, file_path
+            FROM processing_cycles 
+            ORDER BY RANDOM()
+            LIMIT ?
+        """, (n,))
+        return self.db.cursor.fetchall()
+        
     def get_billing_code_history(self, billing_code):
         """Get historical data for a specific billing code."""
         self.db.cursor.execute("""
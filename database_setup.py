@@ -7,37 +7,185 @@ Description: Creates and initializes the SQLite database for storing all billing
 
 import sqlite3
 import os
+from contextlib import closing, contextmanager
+from itertools import islice
+from pathlib import Path
 import pandas as pd
-from datetime import datetime
+from datetime import datetime, timezone
 import logging
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Applied on every connect; WAL with NORMAL sync costs one fsync per checkpoint instead of per commit
+DEFAULT_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "temp_store": "MEMORY",
+    "cache_size": -64000,
+    "mmap_size": 268435456,
+    "busy_timeout": 5000,
+}
+
+# Subset of the PRAGMAs that applies to read-only connections (journal and sync belong to the writer)
+_READONLY_PRAGMAS = ("temp_store", "cache_size", "mmap_size", "busy_timeout")
+
+# Secondary indexes as (name, table, columns)
+_INDEXES = [
+    ("idx_billing_data_code_id", "billing_data", "code_id"),
+    # Recent anomalies (is_anomaly = 1 ORDER BY cycle_id DESC) walk this index backwards and stop at the LIMIT
+    ("idx_billing_data_anomaly_cycle", "billing_data", "is_anomaly, cycle_id DESC"),
+    # Per-code history and COUNT(DISTINCT billing_code) across all cycles
+    ("idx_billing_data_billing_code", "billing_data", "billing_code"),
+    ("idx_billing_codes_code", "billing_codes", "billing_code"),
+    # Per-cycle composites: anomaly summary seeks (cycle_id, is_anomaly), processing stats read only
+    # the index, and plain cycle_id lookups use either one's leading column
+    ("idx_billing_data_cycle_anomaly_type", "billing_data", "cycle_id, is_anomaly, bill_type"),
+    ("idx_billing_data_cycle_code", "billing_data", "cycle_id, billing_code, is_anomaly, bill_type"),
+    ("idx_processing_log_cycle_id", "processing_log", "cycle_id"),
+]
+
+# Indexes replaced by wider ones above, dropped from existing databases
+_SUPERSEDED_INDEXES = (
+    "idx_billing_data_anomaly",
+    "idx_billing_data_cycle_id",
+)
+
+# billing_data columns in the order insert_billing_data expects each row tuple
+BILLING_DATA_COLUMNS = (
+    "cycle_id", "code_id", "billing_code", "bill_type", "year", "month", "bill_cycle_number",
+    "amount_5_months_ago", "amount_4_months_ago", "amount_3_months_ago",
+    "amount_2_months_ago", "amount_1_month_ago", "active_month_amount",
+    "rolling_average", "active_vs_avg", "pct_change_active_vs_avg",
+    "mom_change", "pct_change_mom", "drop_to_zero", "new_code",
+    "active_vs_avg_z_score", "is_anomaly", "description",
+)
+
+_INSERT_BILLING_DATA = f"""
+    INSERT INTO billing_data ({', '.join(BILLING_DATA_COLUMNS)})
+    VALUES ({', '.join('?' * len(BILLING_DATA_COLUMNS))})
+"""
+
+_INSERT_PROCESSING_LOG = """
+    INSERT INTO processing_log (cycle_id, log_level, message, timestamp)
+    VALUES (?, ?, ?, ?)
+"""
+
+_INSERT_CONFIG = """
+    INSERT OR REPLACE INTO processing_config (config_name, config_value, description)
+    VALUES (?, ?, ?)
+"""
+
 class BillingDatabase:
-    def __init__(self, db_path="billing_anomaly_detection.db"):
-        """Initialize the database connection."""
+    def __init__(self, db_path="billing_anomaly_detection.db", pragmas=None):
+        """Initialize the database connection.
+        
+        pragmas overrides or extends DEFAULT_PRAGMAS for this connection.
+        """
         self.db_path = db_path
+        self.pragmas = {**DEFAULT_PRAGMAS, **(pragmas or {})}
         self.conn = None
         self.cursor = None
+        # Processing events waiting to be written; see log_processing_event
+        self._log_buffer = []
+        self.log_flush_size = 500
+        # While True, commit() is deferred so a whole batch of cycles is one transaction
+        self._batch = False
         
     def connect(self):
         """Establish database connection."""
         try:
-            self.conn = sqlite3.connect(self.db_path)
+            # Room for every statement this class and DatabaseIntegration prepare
+            self.conn = sqlite3.connect(self.db_path, cached_statements=1024)
             self.cursor = self.conn.cursor()
+            for name, value in self.pragmas.items():
+                self.cursor.execute(f"PRAGMA {name}={value}")
             logger.info(f"Connected to database: {self.db_path}")
         except Exception as e:
             logger.error(f"Failed to connect to database: {e}")
             raise
             
+    def open_readonly(self):
+        """Open a second, read-only connection for long reads such as exports.
+        
+        Under WAL it reads a consistent snapshot without holding up writes on self.conn.
+        """
+        conn = sqlite3.connect(f"{Path(self.db_path).resolve().as_uri()}?mode=ro", uri=True)
+        for name in _READONLY_PRAGMAS:
+            if name in self.pragmas:
+                conn.execute(f"PRAGMA {name}={self.pragmas[name]}")
+        return conn
+            
     def disconnect(self):
         """Close database connection."""
         if self.conn:
-            self.conn.close()
+            try:
+                self.flush_log()
+            finally:
+                self.conn.close()
+            self.conn = None
+            self.cursor = None
             logger.info("Database connection closed")
             
+    def commit(self):
+        """Commit the current transaction, unless a batch is deferring commits."""
+        if not self._batch:
+            self.conn.commit()
+            
+    def begin_batch(self):
+        """Defer commit() until end_batch(), so a run of cycles is one ordinary WAL transaction.
+        
+        Durability and concurrent readers are unaffected; write_transaction() blocks
+        become savepoints, so a failed cycle is undone without losing the others.
+        """
+        self.flush_log()
+        self.conn.commit()
+        self._batch = True
+        
+    def end_batch(self):
+        """Commit everything written since begin_batch()."""
+        self._batch = False
+        self.flush_log()
+        self.conn.commit()
+            
+    @contextmanager
+    def write_transaction(self):
+        """Run a block of reads and writes as one transaction holding the write lock throughout.
+        
+        BEGIN IMMEDIATE waits (up to busy_timeout) for other writers before the block
+        reads anything, so a select-then-insert cannot race another process. The block
+        commits on success and rolls back on error. Inside a batch or another open
+        transaction it is a savepoint instead, released on success and rolled back to
+        on error.
+        """
+        if self._batch or self.conn.in_transaction:
+            if not self.conn.in_transaction:
+                self.cursor.execute("BEGIN IMMEDIATE")
+            self.cursor.execute("SAVEPOINT write_block")
+            try:
+                yield
+            except BaseException:
+                self.cursor.execute("ROLLBACK TO write_block")
+                self.cursor.execute("RELEASE write_block")
+                raise
+            self.cursor.execute("RELEASE write_block")
+            return
+        self.cursor.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.conn.rollback()
+            raise
+        self.conn.commit()
+            
+    def _create_indexes(self):
+        """Create any missing secondary indexes."""
+        for name in _SUPERSEDED_INDEXES:
+            self.cursor.execute(f"DROP INDEX IF EXISTS {name}")
+        for name, table, columns in _INDEXES:
+            self.cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table}({columns})")
+            
     def create_tables(self):
         """Create all necessary tables for the billing anomaly detection system."""
         
@@ -130,11 +278,7 @@ class BillingDatabase:
         """)
         
         # Create indexes for better performance
-        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_billing_data_cycle_id ON billing_data(cycle_id)")
-        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_billing_data_code_id ON billing_data(code_id)")
-        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_billing_data_anomaly ON billing_data(is_anomaly)")
-        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_billing_codes_code ON billing_codes(billing_code)")
-        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_processing_log_cycle_id ON processing_log(cycle_id)")
+        self._create_indexes()
         
         self.conn.commit()
         logger.info("All tables created successfully")
@@ -154,15 +298,33 @@ class BillingDatabase:
             ("add_percent_threshold", "0.25", "Line Add-ons percent change threshold")
         ]
         
-        for config_name, config_value, description in default_configs:
-            self.cursor.execute("""
-                INSERT OR REPLACE INTO processing_config (config_name, config_value, description)
-                VALUES (?, ?, ?)
-            """, (config_name, config_value, description))
+        # One statement and one transaction for all rows
+        self.cursor.executemany(_INSERT_CONFIG, default_configs)
             
         self.conn.commit()
         logger.info("Default configuration inserted")
         
+    def insert_billing_data(self, rows, batch_size=10000):
+        """Insert billing_data rows (tuples in BILLING_DATA_COLUMNS order) in one transaction.
+        
+        rows may be any iterable, e.g. a generator; it is consumed in batches
+        of batch_size so large cycles are never materialized at once.
+        Returns the number of rows inserted.
+        """
+        rows = iter(rows)
+        inserted = 0
+        with self.write_transaction():
+            while batch := list(islice(rows, batch_size)):
+                self.cursor.executemany(_INSERT_BILLING_DATA, batch)
+                inserted += len(batch)
+        return inserted
+        
+    def analyze(self):
+        """Refresh query-planner statistics; run once after loading many cycles."""
+        self.cursor.execute("ANALYZE")
+        self.conn.commit()
+        logger.info("Database statistics updated")
+        
     def get_config_value(self, config_name):
         """Get a configuration value from the database."""
         self.cursor.execute("SELECT config_value FROM processing_config WHERE config_name = ?", (config_name,))
@@ -170,12 +332,24 @@ class BillingDatabase:
         return result[0] if result else None
         
     def log_processing_event(self, cycle_id, log_level, message):
-        """Log a processing event."""
-        self.cursor.execute("""
-            INSERT INTO processing_log (cycle_id, log_level, message)
-            VALUES (?, ?, ?)
-        """, (cycle_id, log_level, message))
-        self.conn.commit()
+        """Log a processing event.
+        
+        Events are buffered and written log_flush_size at a time, on flush_log()
+        and on disconnect. The timestamp is taken now, in the same UTC format as
+        CURRENT_TIMESTAMP, so batched rows keep their real event times.
+        """
+        timestamp = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        self._log_buffer.append((cycle_id, log_level, message, timestamp))
+        if len(self._log_buffer) >= self.log_flush_size:
+            self.flush_log()
+            
+    def flush_log(self):
+        """Write all buffered processing events in one transaction."""
+        if not self._log_buffer:
+            return
+        self.cursor.executemany(_INSERT_PROCESSING_LOG, self._log_buffer)
+        self.commit()
+        self._log_buffer.clear()
         
     def get_processing_stats(self, cycle_id):
         """Get processing statistics for a cycle."""
@@ -206,41 +380,52 @@ class BillingDatabase:
         
     def export_cycle_data(self, cycle_id, output_path):
         """Export all data for a specific cycle to Excel."""
-        # Get cycle info
-        self.cursor.execute("SELECT * FROM processing_cycles WHERE cycle_id = ?", (cycle_id,))
-        cycle_info = self.cursor.fetchone()
-        
-        if not cycle_info:
-            logger.error(f"Cycle {cycle_id} not found")
-            return False
+        with closing(self.open_readonly()) as conn:
+            # Get cycle info
+            cycle_info = conn.execute("SELECT * FROM processing_cycles WHERE cycle_id = ?", (cycle_id,)).fetchone()
             
-        # Get all billing data for the cycle
-        query = """
-            SELECT 
-                bd.*,
-                bc.description as code_description
-            FROM billing_data bd
-            LEFT JOIN billing_codes bc ON bd.code_id = bc.code_id
-            WHERE bd.cycle_id = ?
-            ORDER BY bd.bill_type, bd.billing_code
-        """
-        
-        df = pd.read_sql_query(query, self.conn, params=(cycle_id,))
-        
-        # Create output directory if it doesn't exist
-        os.makedirs(os.path.dirname(output_path), exist_ok=True)
-        
-        # Export to Excel
-        with pd.ExcelWriter(output_path, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='All_Data', index=False)
+            if not cycle_info:
+                logger.error(f"Cycle {cycle_id} not found")
+                return False
+                
+            # All billing data for the cycle; the Anomalies sheet filters the same query in SQL
+            query = """
+                SELECT 
+                    bd.*,
+                    bc.description as code_description
+                FROM billing_data bd
+                LEFT JOIN billing_codes bc ON bd.code_id = bc.code_id
+                WHERE bd.cycle_id = ?{}
+                ORDER BY bd.bill_type, bd.billing_code
+            """
+            
+            # Create output directory if it doesn't exist
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
             
-            # Create anomaly summary sheet
-            anomaly_df = df[df['is_anomaly'] == 1].copy()
-            if not anomaly_df.empty:
-                anomaly_df.to_excel(writer, sheet_name='Anomalies', index=False)
+            # Export to Excel
+            with pd.ExcelWriter(output_path, engine='xlsxwriter') as writer:
+                self._write_query_to_sheet(conn, writer, 'All_Data', query.format(""), (cycle_id,), keep_empty=True)
+                
+                # Create anomaly summary sheet
+                self._write_query_to_sheet(conn, writer, 'Anomalies', query.format(" AND bd.is_anomaly = 1"), (cycle_id,))
                 
         logger.info(f"Cycle data exported to: {output_path}")
         return True
+        
+    def _write_query_to_sheet(self, conn, writer, sheet_name, query, params, keep_empty=False, chunksize=50000):
+        """Write a query result to one sheet, reading it chunksize rows at a time.
+        
+        Empty results are skipped unless keep_empty, which writes just the header.
+        Returns the number of rows written.
+        """
+        rows = 0
+        for chunk in pd.read_sql_query(query, conn, params=params, chunksize=chunksize):
+            if chunk.empty and (rows or not keep_empty):
+                continue
+            chunk.to_excel(writer, sheet_name=sheet_name, index=False,
+                           header=not rows, startrow=rows + 1 if rows else 0)
+            rows += len(chunk)
+        return rows
 
 def setup_database():
     """Main function to set up the database."""
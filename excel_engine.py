@@ -0,0 +1,12 @@
+"""
+Excel Reader Engine for Telecom Billing Anomaly Detection
+Author: Dylan Alexander Knox
+Description: Picks the pandas read_excel engine shared by the pipeline and the sample data generator.
+"""
+
+# Prefer the Rust-based calamine reader (pandas >= 2.2) when it is installed
+try:
+    import python_calamine  # noqa: F401
+    EXCEL_READ_ENGINE = "calamine"
+except ImportError:
+    EXCEL_READ_ENGINE = "openpyxl"
@@ -8,8 +8,11 @@ Description: Generates 30 billing cycles across 3 sequential months for comprehe
 import pandas as pd
 import numpy as np
 import os
-import random
+import json
+import xlsxwriter
 from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+from excel_engine import EXCEL_READ_ENGINE
 
 # Output directory
 DATA_DIR = "data"
@@ -19,6 +22,8 @@ if not os.path.exists(SAMPLE_DATA_DIR):
 
 months = [f"{i}_Months_ago" for i in range(5, 0, -1)]
 current_month = "Active Month"
+# Left empty in generated sheets (descriptions come from the description files), so only the header is written
+BLANK_COLUMNS = ["Billing Code Description"]
 sheet_types = [
     ("Single Event Charges", "SEC"),
     ("Account Corrections", "ACR"),
@@ -32,105 +37,154 @@ START_YEAR = 2025
 CYCLES_PER_MONTH = 10
 TOTAL_MONTHS = 3
 TOTAL_CYCLES = CYCLES_PER_MONTH * TOTAL_MONTHS
+MIN_SHEET_ROWS = 100
+MAX_SHEET_ROWS = 200
 
 # Load available codes from description files for SEC and ACR
 def get_available_codes(desc_path):
-    df = pd.read_excel(desc_path)
-    return list(df['Billing_CODE'])
+    # Reuse the code list saved next to the workbook unless the workbook is newer
+    cache_path = desc_path + ".codes.json"
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(desc_path):
+        try:
+            with open(cache_path) as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            pass  # Unreadable or damaged cache: parse the workbook and rewrite it
 
-SEC_CODES = get_available_codes(os.path.join('data', 'descriptions', 'Single_Event_Charges_Descriptions.xlsx'))
-ACR_CODES = get_available_codes(os.path.join('data', 'descriptions', 'Account_Corrections_Descriptions.xlsx'))
+    df = pd.read_excel(desc_path, engine=EXCEL_READ_ENGINE)
+    codes = df['Billing_CODE'].tolist()
+    # Write to a per-process temp file and rename it, so readers never see a partial list
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w") as f:
+            json.dump(codes, f)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # Read-only checkout: just parse the workbook each run
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return codes
+
+# Object arrays so rng.choice samples them without converting a list on every call
+SEC_CODES = np.array(get_available_codes(os.path.join('data', 'descriptions', 'Single_Event_Charges_Descriptions.xlsx')), dtype=object)
+ACR_CODES = np.array(get_available_codes(os.path.join('data', 'descriptions', 'Account_Corrections_Descriptions.xlsx')), dtype=object)
+AVAILABLE_CODES = {"SEC": SEC_CODES, "ACR": ACR_CODES}
 
 # Helper to generate codes for SUB and ADD
 def make_codes(prefix, n):
-    return [f"{prefix}{str(i).zfill(3)}" for i in range(1, n+1)]
+    return np.char.add(prefix, np.char.zfill(np.arange(1, n+1).astype(str), 3))
+
+# SUB and ADD codes are sequential, so build the longest list once and slice it per sheet
+SEQUENTIAL_CODES = {prefix: make_codes(prefix, MAX_SHEET_ROWS) for prefix in ("SUB", "ADD")}
+
+# Per-row generation parameters for the historical months (1_Months_ago .. 5_Months_ago) and the active month
+AMOUNT_TRENDS = np.array([5, 4, 3, 2, 1, 5])[:, None]
+AMOUNT_STEPS = (np.array([50_000] * 5 + [100_000])[:, None], np.array([300_000] * 5 + [500_000])[:, None])
+AMOUNT_NOISE = np.array([200_000] * 5 + [1_000_000])[:, None]
+
+def make_sheet(prefix, n, available_codes=None, month_offset=0, rng=None,
+               year=START_YEAR, month=None, cycle_number=1):
+    """Generate sheet columns (name -> array of n values) with month offset for historical data."""
+    if rng is None:
+        rng = np.random.default_rng()
 
-def make_sheet(prefix, n, available_codes=None, month_offset=0):
-    """Generate sheet data with month offset for historical data."""
     if available_codes is not None:
         # Randomly sample from available codes (with replacement if n > len(available_codes))
-        codes = random.choices(available_codes, k=n)
+        codes = rng.choice(available_codes, size=n)
+    elif prefix in SEQUENTIAL_CODES and n <= MAX_SHEET_ROWS:
+        codes = SEQUENTIAL_CODES[prefix][:n]
     else:
         codes = make_codes(prefix, n)
     
     # Base values with some variation based on month
-    base_values = np.random.uniform(1_000_000, 17_000_000, n) + (month_offset * 100_000)
+    base_values = rng.uniform(1_000_000, 17_000_000, n) + (month_offset * 100_000)
+    
+    if month is None:
+        month = START_MONTH + month_offset
     
     data = {
-        "Year": [START_YEAR] * n,
-        "Month": [START_MONTH + month_offset] * n,
-        "Bill Cycle Number": [1] * n,  # Will be updated per cycle
-        "Bill_TYPE": [prefix] * n,
+        "Year": np.full(n, year, dtype=np.int32),
+        "Month": np.full(n, month, dtype=np.int8),
+        "Bill Cycle Number": np.full(n, cycle_number, dtype=np.int8),
+        "Bill_TYPE": np.full(n, prefix, dtype=object),
         "Billing_CODE": codes,
     }
     
-    # Generate historical data with increasing trend over months
-    for i, m in enumerate(months[::-1]):
-        month_trend = month_offset + (5 - i)  # Historical months
-        data[m] = (base_values + 
-                   month_trend * np.random.uniform(50_000, 300_000, n) + 
-                   np.random.normal(0, 200_000, n)).clip(0, 18_000_000).round(2)
-    
-    # Current month (active month)
-    current_month_trend = month_offset + 5
-    data[current_month] = (base_values + 
-                          current_month_trend * np.random.uniform(100_000, 500_000, n) + 
-                          np.random.normal(0, 1_000_000, n)).clip(0, 18_000_000).round(2)
-    
-    data["Billing Code Description"] = ["" for _ in range(n)]
-    df = pd.DataFrame(data)
-    return df
+    # Historical months with increasing trend, then the current (active) month, as one (6, n) draw
+    amounts = (base_values +
+               (month_offset + AMOUNT_TRENDS) * rng.uniform(*AMOUNT_STEPS, size=(6, n)) +
+               rng.normal(0, AMOUNT_NOISE, size=(6, n))).clip(0, 18_000_000).round(2)
+    data.update(zip(months[::-1] + [current_month], amounts))
+    return data
+
+def write_sheet(worksheet, data, header_format=None):
+    """Write make_sheet columns to a worksheet in row order, as constant_memory requires."""
+    worksheet.write_row(0, 0, list(data) + BLANK_COLUMNS, header_format)
+    # tolist() hands xlsxwriter plain Python numbers and strings
+    columns = [np.asarray(values).tolist() for values in data.values()]
+    for row, values in enumerate(zip(*columns), start=1):
+        worksheet.write_row(row, 0, values)
 
-def generate_cycle_data(month, year, cycle_number, month_offset=0):
+def generate_cycle_data(month, year, cycle_number, month_offset=0, rng=None):
     """Generate data for a specific cycle."""
+    if rng is None:
+        rng = np.random.default_rng()
     sheets = {}
     
     for sheet_name, prefix in sheet_types:
-        n_rows = random.randint(100, 200)
-        if prefix == "SEC":
-            sheets[sheet_name] = make_sheet(prefix, n_rows, available_codes=SEC_CODES, month_offset=month_offset)
-        elif prefix == "ACR":
-            sheets[sheet_name] = make_sheet(prefix, n_rows, available_codes=ACR_CODES, month_offset=month_offset)
-        else:
-            sheets[sheet_name] = make_sheet(prefix, n_rows, month_offset=month_offset)
-        
-        # Update cycle number for all sheets
-        sheets[sheet_name]["Bill Cycle Number"] = cycle_number
-        sheets[sheet_name]["Year"] = year
-        sheets[sheet_name]["Month"] = month
+        n_rows = rng.integers(MIN_SHEET_ROWS, MAX_SHEET_ROWS, endpoint=True)
+        # SEC and ACR sample real codes; SUB and ADD use sequential ones
+        sheets[sheet_name] = make_sheet(prefix, n_rows, available_codes=AVAILABLE_CODES.get(prefix),
+                                        month_offset=month_offset, rng=rng,
+                                        year=year, month=month, cycle_number=cycle_number)
     
     return sheets
 
-def generate_extended_sample_data():
-    """Generate 30 cycles across 3 months with random cycle numbers 1-30 in sequential order."""
-    generated_files = []
+def generate_cycle_file(current_month, current_year, cycle_num, month_offset, seed):
+    """Generate one cycle workbook from its own RNG stream and return its path."""
+    # Generate data for this cycle
+    sheets = generate_cycle_data(current_month, current_year, cycle_num, month_offset,
+                                 rng=np.random.default_rng(seed))
+    
+    # Create filename
+    month_str = str(current_month).zfill(2)
+    billing_file = os.path.join(SAMPLE_DATA_DIR, 
+                              f"Sample_Billing_Cycle_{month_str}-{cycle_num}-{current_year}.xlsx")
     
-    # Create random cycle numbers 1-30 for each month
-    all_cycle_numbers = list(range(1, 31))  # 1-30
+    # Write to Excel, streaming each row to disk
+    with xlsxwriter.Workbook(billing_file, {"constant_memory": True}) as workbook:
+        header_format = workbook.add_format({"bold": True, "border": 1, "align": "center"})
+        for sheet, data in sheets.items():
+            write_sheet(workbook.add_worksheet(sheet), data, header_format)
+    
+    return billing_file
+
+def generate_extended_sample_data(seed=None):
+    """Generate 30 cycles across 3 months with random cycle numbers 1-30 in sequential order.
+    
+    Pass a seed to reproduce the same files; by default every run differs.
+    """
+    seed_sequence = np.random.SeedSequence(seed)
+    rng = np.random.default_rng(seed_sequence)
+    tasks = []
     
     for month_offset in range(TOTAL_MONTHS):
         current_month = START_MONTH + month_offset
         current_year = START_YEAR
         
-        # Get 10 random cycle numbers for this month (in sequential order)
-        month_cycle_numbers = sorted(random.sample(all_cycle_numbers, CYCLES_PER_MONTH))
+        # Get 10 random cycle numbers 1-30 for this month (in sequential order)
+        month_cycle_numbers = np.sort(rng.choice(30, size=CYCLES_PER_MONTH, replace=False)) + 1
         
-        for i, cycle_num in enumerate(month_cycle_numbers):
-            # Generate data for this cycle
-            sheets = generate_cycle_data(current_month, current_year, cycle_num, month_offset)
-            
-            # Create filename
-            month_str = str(current_month).zfill(2)
-            billing_file = os.path.join(SAMPLE_DATA_DIR, 
-                                      f"Sample_Billing_Cycle_{month_str}-{cycle_num}-{current_year}.xlsx")
-            
-            # Write to Excel
-            with pd.ExcelWriter(billing_file, engine="openpyxl") as writer:
-                for sheet, df in sheets.items():
-                    df.to_excel(writer, sheet_name=sheet, index=False)
-            
-            generated_files.append(billing_file)
-            print(f"Generated cycle {cycle_num} for month {current_month}/{current_year}: {billing_file}")
+        for cycle_num in month_cycle_numbers.tolist():
+            tasks.append((current_month, current_year, cycle_num, month_offset))
+    
+    # Cycles are independent: generate them in parallel, each from its own child seed
+    seeds = seed_sequence.spawn(len(tasks))
+    with ProcessPoolExecutor(max_workers=min(len(tasks), os.cpu_count() or 1)) as executor:
+        generated_files = list(executor.map(generate_cycle_file, *zip(*tasks), seeds))
+    
+    for (current_month, current_year, cycle_num, _), billing_file in zip(tasks, generated_files):
+        print(f"Generated cycle {cycle_num} for month {current_month}/{current_year}: {billing_file}")
     
     return generated_files
 
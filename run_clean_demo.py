@@ -6,18 +6,21 @@ Description: Streamlined demo with 30 cycles generated, stored in SQLite, anomal
 """
 
 import os
+import re
 import sys
 import logging
-import random
 from datetime import datetime
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Month, cycle number and year of a generated sample file
+_CYCLE_RE = re.compile(r"Sample_Billing_Cycle_(\d{2})-(\d+)-(\d{4})")
+
 def check_dependencies():
     """Check if required dependencies are installed."""
-    required_packages = ['pandas', 'numpy', 'openpyxl', 'sqlite3']
+    required_packages = ['pandas', 'numpy', 'openpyxl', 'xlsxwriter', 'sqlite3']
     missing_packages = []
     
     for package in required_packages:
@@ -34,6 +37,22 @@ def check_dependencies():
     logger.info("All required dependencies are installed.")
     return True
 
+# The demo steps import these anyway, so a missing package fails here instead of probing on every run
+try:
+    import pandas  # noqa: F401
+    import numpy  # noqa: F401
+    import openpyxl  # noqa: F401
+    import xlsxwriter  # noqa: F401
+except ImportError:
+    check_dependencies()
+    sys.exit(1)
+
+def _run_pipeline(file_path):
+    """Load a billing cycle workbook and run anomaly detection on it."""
+    import anomaly_detection_with_db
+    df, mm_cc_yyyy, _ = anomaly_detection_with_db.load_sample_billing_data(file_path)
+    return anomaly_detection_with_db.run_pipeline(df), mm_cc_yyyy
+
 def setup_database():
     """Set up the SQLite database."""
     logger.info("Setting up SQLite database...")
@@ -46,62 +65,58 @@ def setup_database():
         logger.error(f"Database setup failed: {e}")
         return False
 
-def generate_and_store_30_cycles():
+def generate_and_store_30_cycles(db_integration):
     """Generate 30 cycles and store them all in SQLite."""
     logger.info("Generating and storing 30 cycles in SQLite...")
     try:
         import generate_extended_sample_data
-        from database_integration import DatabaseIntegration
         
         # Generate 30 cycles across 3 months
         generated_files = generate_extended_sample_data.generate_extended_sample_data()
         logger.info(f"Generated {len(generated_files)} billing cycle files")
         
-        # Store all cycles in database
-        db_integration = DatabaseIntegration()
+        # Store all cycles in database as one transaction, committed once at the end
+        db_integration.db.begin_batch()
         
         stored_count = 0
-        for file_path in generated_files:
-            try:
-                # Extract cycle info from filename
-                import re
-                match = re.search(r"Sample_Billing_Cycle_(\d{2})-(\d+)-(\d{4})", os.path.basename(file_path))
-                if match:
-                    month = int(match.group(1))
-                    cycle_num = int(match.group(2))
-                    year = int(match.group(3))
-                    cycle_date = f"{year}-{month:02d}-01"
-                    
-                    # Create processing cycle
-                    cycle_id = db_integration.create_processing_cycle(
-                        cycle_date=cycle_date,
-                        cycle_number=cycle_num,
-                        year=year,
-                        month=month,
-                        file_path=file_path
-                    )
-                    
-                    # Load data and store in database
-                    import anomaly_detection_with_db
-                    df, mm_cc_yyyy, _ = anomaly_detection_with_db.load_sample_billing_data(file_path)
-                    df = anomaly_detection_with_db.clean_data(df)
-                    df = anomaly_detection_with_db.calculate_rolling_average(df)
-                    df = anomaly_detection_with_db.calculate_deltas(df)
-                    df = anomaly_detection_with_db.flag_special_cases(df)
-                    df = anomaly_detection_with_db.flag_anomalies(df)
-                    
-                    # Store in database
-                    records_stored = db_integration.store_billing_data(cycle_id, df)
-                    db_integration.update_processing_cycle_stats(cycle_id)
-                    
-                    stored_count += 1
-                    logger.info(f"Stored cycle {cycle_num} for month {month}/{year} ({records_stored} records)")
-                    
-            except Exception as e:
-                logger.error(f"Failed to store cycle from {file_path}: {e}")
-                continue
+        try:
+            for file_path in generated_files:
+                try:
+                    # Extract cycle info from filename
+                    match = _CYCLE_RE.search(os.path.basename(file_path))
+                    if match:
+                        month = int(match.group(1))
+                        cycle_num = int(match.group(2))
+                        year = int(match.group(3))
+                        cycle_date = f"{year}-{month:02d}-01"
+                        
+                        # Create processing cycle
+                        cycle_id = db_integration.create_processing_cycle(
+                            cycle_date=cycle_date,
+                            cycle_number=cycle_num,
+                            year=year,
+                            month=month,
+                            file_path=file_path
+                        )
+                        
+                        # Load data and run anomaly detection
+                        df, mm_cc_yyyy = _run_pipeline(file_path)
+                        
+                        # Store in database
+                        records_stored = db_integration.store_billing_data(cycle_id, df)
+                        db_integration.update_processing_cycle_stats(cycle_id)
+                        
+                        stored_count += 1
+                        logger.info(f"Stored cycle {cycle_num} for month {month}/{year} ({records_stored} records)")
+                        
+                except Exception as e:
+                    logger.error(f"Failed to store cycle from {file_path}: {e}")
+                    continue
+        finally:
+            db_integration.db.end_batch()
         
-        del db_integration
+        # Let the planner pick the per-cycle indexes for the queries that follow
+        db_integration.db.analyze()
         logger.info(f"Successfully stored {stored_count} cycles in database")
         return True
         
@@ -109,54 +124,35 @@ def generate_and_store_30_cycles():
         logger.error(f"Failed to generate and store cycles: {e}")
         return False
 
-def run_anomaly_detection_demo(num_cycles=2):
+def run_anomaly_detection_demo(db_integration, num_cycles=2):
     """Run anomaly detection demo on a few cycles."""
     logger.info(f"Running anomaly detection demo on {num_cycles} cycles...")
     try:
         import anomaly_detection_with_db
-        from database_integration import DatabaseIntegration
         
-        # Get recent cycles from database
-        db_integration = DatabaseIntegration()
-        cycles = db_integration.get_all_cycles()
+        # Select random cycles for demo (fewer rows back means that is every cycle stored)
+        demo_cycles = db_integration.get_random_cycles(num_cycles)
         
-        if len(cycles) < num_cycles:
-            logger.error(f"Not enough cycles in database. Found {len(cycles)}, need {num_cycles}")
+        if len(demo_cycles) < num_cycles:
+            logger.error(f"Not enough cycles in database. Found {len(demo_cycles)}, need {num_cycles}")
             return False
         
-        # Select random cycles for demo
-        demo_cycles = random.sample(cycles, num_cycles)
-        
         for i, cycle in enumerate(demo_cycles):
-            cycle_id, cycle_date, cycle_num, year, month, total_rec, anomaly_count, status, timestamp = cycle
+            cycle_id, cycle_date, cycle_num, year, month, total_rec, anomaly_count, status, timestamp, file_path = cycle
             
             logger.info(f"Running anomaly detection demo {i+1}/{num_cycles}: Cycle {cycle_num} ({month}/{year})")
             
-            # Get the file path for this cycle
-            db_integration.db.cursor.execute("""
-                SELECT file_path FROM processing_cycles WHERE cycle_id = ?
-            """, (cycle_id,))
-            result = db_integration.db.cursor.fetchone()
-            
-            if result and result[0]:
-                file_path = result[0]
-                
+            if file_path:
                 # Run anomaly detection and generate Excel report
-                df, mm_cc_yyyy, _ = anomaly_detection_with_db.load_sample_billing_data(file_path)
-                df = anomaly_detection_with_db.clean_data(df)
-                df = anomaly_detection_with_db.calculate_rolling_average(df)
-                df = anomaly_detection_with_db.calculate_deltas(df)
-                df = anomaly_detection_with_db.flag_special_cases(df)
-                df = anomaly_detection_with_db.flag_anomalies(df)
+                df, mm_cc_yyyy = _run_pipeline(file_path)
                 
                 # Generate Excel report (for analyst review)
-                anomaly_detection_with_db.output_results(df, mm_cc_yyyy, cycle_id)
+                anomaly_detection_with_db.output_results(df, mm_cc_yyyy, cycle_id, db_integration)
                 
                 logger.info(f"Generated anomaly report for cycle {cycle_num}")
             else:
                 logger.warning(f"No file path found for cycle {cycle_id}")
         
-        del db_integration
         logger.info("Anomaly detection demo completed successfully.")
         return True
         
@@ -164,33 +160,25 @@ def run_anomaly_detection_demo(num_cycles=2):
         logger.error(f"Anomaly detection demo failed: {e}")
         return False
 
-def show_database_summary():
+def show_database_summary(db):
     """Show a summary of the database contents."""
     logger.info("Database Summary:")
     try:
-        from database_integration import DatabaseIntegration
-        
-        db = DatabaseIntegration()
-        
-        # Get all cycles
-        cycles = db.get_all_cycles()
-        if cycles:
-            logger.info(f"Total cycles in database: {len(cycles)}")
-            
-            # Group by month
-            monthly_stats = {}
-            for cycle in cycles:
-                cycle_id, cycle_date, cycle_num, year, month, total_rec, anomaly_count, status, timestamp = cycle
-                month_key = f"{year}-{month:02d}"
-                if month_key not in monthly_stats:
-                    monthly_stats[month_key] = {"cycles": 0, "total_records": 0, "total_anomalies": 0}
-                monthly_stats[month_key]["cycles"] += 1
-                monthly_stats[month_key]["total_records"] += total_rec or 0
-                monthly_stats[month_key]["total_anomalies"] += anomaly_count or 0
+        # Group cycles by month in SQLite
+        db.db.cursor.execute("""
+            SELECT printf('%04d-%02d', year, month) AS month_key, COUNT(*),
+                   COALESCE(SUM(total_records), 0), COALESCE(SUM(anomaly_count), 0)
+            FROM processing_cycles
+            GROUP BY month_key
+            ORDER BY month_key
+        """)
+        monthly_stats = db.db.cursor.fetchall()
+        if monthly_stats:
+            logger.info(f"Total cycles in database: {sum(stats[1] for stats in monthly_stats)}")
             
             logger.info("Monthly Data Summary:")
-            for month_key, stats in sorted(monthly_stats.items()):
-                logger.info(f"  {month_key}: {stats['cycles']} cycles, {stats['total_records']} records, {stats['total_anomalies']} anomalies")
+            for month_key, cycles, total_records, total_anomalies in monthly_stats:
+                logger.info(f"  {month_key}: {cycles} cycles, {total_records} records, {total_anomalies} anomalies")
         else:
             logger.info("No cycles found in database.")
             
@@ -199,8 +187,6 @@ def show_database_summary():
         total_codes = db.db.cursor.fetchone()[0]
         logger.info(f"Total unique billing codes: {total_codes}")
         
-        del db
-        
     except Exception as e:
         logger.error(f"Failed to get database summary: {e}")
 
@@ -220,11 +206,12 @@ def main():
     logger.info("Clean Telecom Billing Anomaly Detection Demo")
     logger.info("=" * 60)
     
-    # Step 1: Check dependencies
-    logger.info("\nStep 1: Checking dependencies...")
-    if not check_dependencies():
-        logger.error("Dependency check failed. Please install missing packages.")
-        return False
+    # Step 1: Check dependencies (imports are already verified at load time; pass --check-deps to list them)
+    if "--check-deps" in sys.argv[1:]:
+        logger.info("\nStep 1: Checking dependencies...")
+        if not check_dependencies():
+            logger.error("Dependency check failed. Please install missing packages.")
+            return False
     
     # Step 2: Create output directories
     logger.info("\nStep 2: Creating output directories...")
@@ -236,28 +223,35 @@ def main():
         logger.error("Database setup failed.")
         return False
     
-    # Step 4: Generate and store 30 cycles
-    logger.info("\nStep 4: Generating and storing 30 cycles...")
-    if not generate_and_store_30_cycles():
-        logger.error("Cycle generation and storage failed.")
-        return False
-    
-    # Step 5: Run anomaly detection demo on 2 cycles
-    logger.info("\nStep 5: Running anomaly detection demo...")
-    if not run_anomaly_detection_demo(num_cycles=2):
-        logger.error("Anomaly detection demo failed.")
-        return False
-    
-    # Step 6: Show database summary
-    logger.info("\nStep 6: Database summary...")
-    show_database_summary()
+    # Steps 4-6 share one connection, so its statement cache stays warm between them
+    from database_integration import DatabaseIntegration
+    db_integration = DatabaseIntegration()
+    try:
+        # Step 4: Generate and store 30 cycles
+        logger.info("\nStep 4: Generating and storing 30 cycles...")
+        if not generate_and_store_30_cycles(db_integration):
+            logger.error("Cycle generation and storage failed.")
+            return False
+        
+        # Step 5: Run anomaly detection demo on 2 cycles
+        logger.info("\nStep 5: Running anomaly detection demo...")
+        if not run_anomaly_detection_demo(db_integration, num_cycles=2):
+            logger.error("Anomaly detection demo failed.")
+            return False
+        
+        # Step 6: Show database summary
+        logger.info("\nStep 6: Database summary...")
+        show_database_summary(db_integration)
+    finally:
+        db_integration.close()
     
     # Step 7: Show output files
     logger.info("\nStep 7: Output files created:")
-    anomaly_files = os.listdir("data/Anomalies") if os.path.exists("data/Anomalies") else []
-    for file in anomaly_files:
-        if file.endswith('.xlsx'):
-            logger.info(f"  data/Anomalies/{file}")
+    if os.path.isdir("data/Anomalies"):
+        with os.scandir("data/Anomalies") as entries:
+            for entry in entries:
+                if entry.name.endswith('.xlsx'):
+                    logger.info(f"  data/Anomalies/{entry.name}")
     
     logger.info("\n" + "=" * 60)
     logger.info("Clean demo completed successfully!")
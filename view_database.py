@@ -5,8 +5,12 @@ Description: View database contents without external tools
 """
 
 import sqlite3
-import pandas as pd
 import os
+import csv
+
+def _or_nan(value):
+    """Turn SQL NULL into NaN so it still formats as a number, as it did in a DataFrame."""
+    return float('nan') if value is None else value
 
 def view_database_summary():
     """Show a summary of what's in the database."""
@@ -19,29 +23,29 @@ def view_database_summary():
     print("=" * 60)
     
     conn = sqlite3.connect('billing_anomaly_detection.db')
+    # Rows are printed one by one, so read them as name-addressable tuples rather than DataFrames
+    conn.row_factory = sqlite3.Row
     
     # Get all table names
-    cursor = conn.cursor()
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-    tables = cursor.fetchall()
+    tables = conn.execute("SELECT name FROM sqlite_master WHERE type='table';").fetchall()
     
     print(f"\n📊 Database contains {len(tables)} tables:")
     for table in tables:
-        print(f"  - {table[0]}")
+        print(f"  - {table['name']}")
     
     # Show processing cycles
     print(f"\n🔄 PROCESSING CYCLES:")
-    cycles_df = pd.read_sql_query("""
+    cycles = conn.execute("""
         SELECT cycle_id, cycle_date, cycle_number, year, month, 
-               total_records, anomaly_count, status, created_at
+               total_records, anomaly_count, status, processing_timestamp
         FROM processing_cycles 
-        ORDER BY created_at DESC
+        ORDER BY processing_timestamp DESC
         LIMIT 10
-    """, conn)
+    """).fetchall()
     
-    if not cycles_df.empty:
-        print(f"Found {len(cycles_df)} processing cycles:")
-        for _, row in cycles_df.iterrows():
+    if cycles:
+        print(f"Found {len(cycles)} processing cycles:")
+        for row in cycles:
             print(f"  Cycle {row['cycle_number']} ({row['month']}/{row['year']}): "
                   f"{row['total_records']} records, {row['anomaly_count']} anomalies")
     else:
@@ -49,43 +53,60 @@ def view_database_summary():
     
     # Show billing data summary
     print(f"\n💰 BILLING DATA:")
-    billing_df = pd.read_sql_query("""
+    billing = conn.execute("""
         SELECT COUNT(*) as total_records,
                COUNT(DISTINCT billing_code) as unique_codes,
-               COUNT(DISTINCT audit_type) as audit_types
+               COUNT(DISTINCT bill_type) as bill_types
         FROM billing_data
-    """, conn)
+    """).fetchone()
     
-    if not billing_df.empty and billing_df.iloc[0]['total_records'] > 0:
-        print(f"  Total billing records: {billing_df.iloc[0]['total_records']}")
-        print(f"  Unique billing codes: {billing_df.iloc[0]['unique_codes']}")
-        print(f"  Audit types: {billing_df.iloc[0]['audit_types']}")
+    if billing['total_records'] > 0:
+        print(f"  Total billing records: {billing['total_records']}")
+        print(f"  Unique billing codes: {billing['unique_codes']}")
+        print(f"  Bill types: {billing['bill_types']}")
     else:
         print("  No billing data found")
     
     # Show recent anomalies
     print(f"\n🚨 RECENT ANOMALIES:")
-    anomalies_df = pd.read_sql_query("""
-        SELECT billing_code, audit_type, active_month, rolling_avg, 
+    anomalies = conn.execute("""
+        SELECT billing_code, bill_type, active_month_amount, rolling_average, 
                active_vs_avg, pct_change_active_vs_avg, is_anomaly
         FROM billing_data 
         WHERE is_anomaly = 1
         ORDER BY cycle_id DESC
         LIMIT 10
-    """, conn)
-    
-    if not anomalies_df.empty:
-        print(f"Found {len(anomalies_df)} recent anomalies:")
-        for _, row in anomalies_df.iterrows():
-            print(f"  {row['billing_code']} ({row['audit_type']}): "
-                  f"${row['active_month']:,.0f} vs avg ${row['rolling_avg']:,.0f} "
-                  f"({row['pct_change_active_vs_avg']:.1%} change)")
+    """).fetchall()
+    
+    if anomalies:
+        print(f"Found {len(anomalies)} recent anomalies:")
+        for row in anomalies:
+            print(f"  {row['billing_code']} ({row['bill_type']}): "
+                  f"${_or_nan(row['active_month_amount']):,.0f} vs avg ${_or_nan(row['rolling_average']):,.0f} "
+                  f"({_or_nan(row['pct_change_active_vs_avg']):.1%} change)")
     else:
         print("  No anomalies found")
     
     conn.close()
     print("\n" + "=" * 60)
 
+def export_query_to_csv(conn, query, csv_path):
+    """Stream a query's rows to a CSV file with a header row; nothing is written if there are no rows."""
+    cursor = conn.execute(query)
+    # Peek at one row so an empty result creates no file, then write the rest straight from the cursor
+    first = cursor.fetchone()
+    if first is None:
+        return 0
+    count = 1
+    with open(csv_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow([column[0] for column in cursor.description])
+        writer.writerow(first)
+        for row in cursor:
+            writer.writerow(row)
+            count += 1
+    return count
+
 def export_sample_data():
     """Export sample data to CSV for easy viewing."""
     if not os.path.exists('billing_anomaly_detection.db'):
@@ -97,25 +118,23 @@ def export_sample_data():
     conn = sqlite3.connect('billing_anomaly_detection.db')
     
     # Export recent billing data
-    billing_df = pd.read_sql_query("""
+    billing_count = export_query_to_csv(conn, """
         SELECT * FROM billing_data 
         ORDER BY cycle_id DESC 
         LIMIT 100
-    """, conn)
+    """, 'sample_billing_data.csv')
     
-    if not billing_df.empty:
-        billing_df.to_csv('sample_billing_data.csv', index=False)
-        print(f"✅ Exported {len(billing_df)} billing records to 'sample_billing_data.csv'")
+    if billing_count:
+        print(f"✅ Exported {billing_count} billing records to 'sample_billing_data.csv'")
     
     # Export processing cycles
-    cycles_df = pd.read_sql_query("""
+    cycles_count = export_query_to_csv(conn, """
         SELECT * FROM processing_cycles 
-        ORDER BY created_at DESC
-    """, conn)
+        ORDER BY processing_timestamp DESC
+    """, 'processing_cycles.csv')
     
-    if not cycles_df.empty:
-        cycles_df.to_csv('processing_cycles.csv', index=False)
-        print(f"✅ Exported {len(cycles_df)} processing cycles to 'processing_cycles.csv'")
+    if cycles_count:
+        print(f"✅ Exported {cycles_count} processing cycles to 'processing_cycles.csv'")
     
     conn.close()
     print("\n💡 You can now open these CSV files in any text editor or spreadsheet app!")